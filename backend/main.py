@@ -1,24 +1,42 @@
 import os
 import json
+import asyncio
+import hashlib
 import tempfile
-from fastapi import FastAPI, HTTPException
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Awaitable
 from datetime import datetime
-from docx import Document
-from docx.shared import Pt, RGBColor, Inches
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from functools import lru_cache
 import io
-import base64
-import requests
+import re
+import random
+import sqlite3
+import unicodedata
+import uuid
+import zlib
 from dotenv import load_dotenv
-import google.generativeai as genai
-from PIL import Image as PILImage
+
+# orjson serializes the large book payloads several times faster than json
+try:
+    import orjson  # noqa: F401
+    DefaultResponse = ORJSONResponse
+except ImportError:
+    DefaultResponse = JSONResponse
+
+# google.generativeai, docx, fpdf and PIL are imported lazily by the helpers
+# below so cold starts (health probes, outline edits) don't pay for them.
 
 load_dotenv()
 
-app = FastAPI(title="BookForge AI Backend")
+app = FastAPI(title="BookForge AI Backend", default_response_class=DefaultResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,14 +46,342 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@lru_cache(maxsize=1)
+def get_brotli():
+    """The brotli module if installed, else None (gzip is used instead)"""
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+class CompressionMiddleware:
+    """Compress JSON/text responses with brotli or gzip, negotiated via
+    Accept-Encoding, and decompress gzip/deflate request bodies sent with
+    Content-Encoding. Streamed responses are flushed chunk by chunk so NDJSON
+    still streams."""
+    
+    COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+    
+    def __init__(self, app, minimum_size: int = 1024, max_request_size: int = 64 * 1024 * 1024,
+                 max_compressed_size: int = 16 * 1024 * 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.max_request_size = max_request_size
+        self.max_compressed_size = max_compressed_size
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        content_encoding = headers.get("content-encoding", "").strip().lower()
+        if content_encoding and content_encoding != "identity":
+            try:
+                body = await self._read_body(receive, content_encoding)
+            except HTTPException as e:
+                response = JSONResponse({"detail": e.detail}, status_code=e.status_code)
+                await response(scope, receive, send)
+                return
+            scope = dict(scope)
+            scope["headers"] = [
+                (k, v) for k, v in scope["headers"]
+                if k.lower() not in (b"content-encoding", b"content-length")
+            ] + [(b"content-length", str(len(body)).encode("latin-1"))]
+            receive = self._replay_receive(receive, body)
+        
+        encoding = self._negotiate(headers.get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        await self.app(scope, receive, self._compressing_send(send, encoding))
+    
+    @staticmethod
+    def _negotiate(accept_encoding: str) -> Optional[str]:
+        """Pick br or gzip from Accept-Encoding, honouring q-values (q=0 refuses)"""
+        qualities = {}
+        for item in accept_encoding.lower().split(","):
+            name, _, params = item.strip().partition(";")
+            if not name:
+                continue
+            q = 1.0
+            for param in params.split(";"):
+                key, _, value = param.strip().partition("=")
+                if key == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            qualities[name.strip()] = q
+        wildcard = qualities.get("*", 0.0)
+        candidates = ["br", "gzip"] if get_brotli() is not None else ["gzip"]
+        best = None
+        for name in candidates:
+            q = qualities.get(name, wildcard)
+            if q > 0 and (best is None or q > best[1]):
+                best = (name, q)
+        return best[0] if best else None
+    
+    async def _read_body(self, receive, encoding: str) -> bytes:
+        """Read and decompress a gzip/deflate request body as it arrives,
+        capping both the compressed and the decompressed size"""
+        if encoding not in ("gzip", "deflate"):
+            raise HTTPException(status_code=415, detail=f"Unsupported request Content-Encoding: {encoding}")
+        wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+        decompressor = zlib.decompressobj(wbits)
+        chunks = []
+        raw_size = 0
+        body_size = 0
+        more_body = True
+        try:
+            while more_body:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    raise HTTPException(status_code=400, detail="Client disconnected while sending the body")
+                data = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                raw_size += len(data)
+                if raw_size > self.max_compressed_size:
+                    raise HTTPException(status_code=413, detail="Compressed request body too large")
+                # Never inflate more than the remaining allowance plus one byte
+                chunk = decompressor.decompress(data, self.max_request_size - body_size + 1)
+                body_size += len(chunk)
+                if body_size > self.max_request_size or decompressor.unconsumed_tail:
+                    raise HTTPException(status_code=413, detail="Decompressed request body too large")
+                chunks.append(chunk)
+            tail = decompressor.flush()
+        except zlib.error as e:
+            raise HTTPException(status_code=400, detail=f"Invalid {encoding} request body: {str(e)}")
+        if body_size + len(tail) > self.max_request_size:
+            raise HTTPException(status_code=413, detail="Decompressed request body too large")
+        chunks.append(tail)
+        return b"".join(chunks)
+    
+    @staticmethod
+    def _replay_receive(receive, body: bytes):
+        sent = False
+        
+        async def replay():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+        return replay
+    
+    def _compressing_send(self, send, encoding: str):
+        start_message = None
+        compressor = None
+        
+        def compress(data: bytes, final: bool) -> bytes:
+            if encoding == "br":
+                out = compressor.process(data)
+                return out + (compressor.finish() if final else compressor.flush())
+            out = compressor.compress(data)
+            return out + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+        
+        async def wrapped(message):
+            nonlocal start_message, compressor
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                response_headers = {k.decode("latin-1").lower(): v.decode("latin-1")
+                                    for k, v in start_message["headers"]}
+                content_type = response_headers.get("content-type", "")
+                skip = (
+                    "content-encoding" in response_headers
+                    or not content_type.startswith(self.COMPRESSIBLE_TYPES)
+                    or (not more_body and len(body) < self.minimum_size)
+                )
+                if skip:
+                    await send(start_message)
+                    start_message = None
+                    await send(message)
+                    return
+                
+                if encoding == "br":
+                    compressor = get_brotli().Compressor(quality=5)
+                else:
+                    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                new_headers = [(k, v) for k, v in start_message["headers"] if k.lower() != b"content-length"]
+                new_headers.append((b"content-encoding", encoding.encode("latin-1")))
+                new_headers.append((b"vary", b"Accept-Encoding"))
+                compressed = compress(body, not more_body)
+                if not more_body:
+                    new_headers.append((b"content-length", str(len(compressed)).encode("latin-1")))
+                await send({**start_message, "headers": new_headers})
+                await send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+                return
+            
+            await send({"type": "http.response.body", "body": compress(body, not more_body), "more_body": more_body})
+        return wrapped
+
+app.add_middleware(CompressionMiddleware)
+
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 GEMINI_MODEL = "gemini-1.5-flash"
+GEMINI_FAST_MODEL = "gemini-1.5-flash-8b"
+
+# Model and generation settings per task. A route with a fallback_model and
+# slo_seconds switches to the fallback while the primary's recent p95 latency
+# is over the SLO. BOOKFORGE_MODEL_ROUTES (JSON) overrides fields per task,
+# e.g. {"chapter": {"slo_seconds": 45}, "outline": {"model": "gemini-1.5-flash"}}
+MODEL_ROUTES: Dict[str, Dict[str, Any]] = {
+    "outline": {
+        "model": GEMINI_FAST_MODEL,
+        "generation_config": {"max_output_tokens": 2048},
+    },
+    "chapter": {
+        "model": GEMINI_MODEL,
+        "fallback_model": GEMINI_FAST_MODEL,
+        "slo_seconds": 60.0,
+        "generation_config": {"max_output_tokens": 4096},
+    },
+    "summary": {
+        "model": GEMINI_FAST_MODEL,
+        "generation_config": {"max_output_tokens": 512, "temperature": 0.3},
+    },
+    "transition": {
+        "model": GEMINI_FAST_MODEL,
+        "generation_config": {"max_output_tokens": 256},
+    },
+}
+
+def apply_route_overrides(raw: str) -> None:
+    """Merge BOOKFORGE_MODEL_ROUTES into MODEL_ROUTES. A malformed value is
+    logged and ignored as a whole so a typo can't break startup."""
+    try:
+        overrides_by_task = json.loads(raw or "{}")
+        if not isinstance(overrides_by_task, dict):
+            raise ValueError("expected a JSON object keyed by task")
+        routes = {task: {**route, "generation_config": dict(route.get("generation_config", {}))}
+                  for task, route in MODEL_ROUTES.items()}
+        for task, overrides in overrides_by_task.items():
+            if not isinstance(overrides, dict) or not isinstance(overrides.get("generation_config", {}), dict):
+                raise ValueError(f"route '{task}' must be an object with an object generation_config")
+            route = routes.setdefault(task, {"model": GEMINI_MODEL, "generation_config": {}})
+            route.update({k: v for k, v in overrides.items() if k != "generation_config"})
+            route["generation_config"].update(overrides.get("generation_config", {}))
+            if not isinstance(route.get("model"), str):
+                raise ValueError(f"route '{task}' needs a model name")
+            if route.get("slo_seconds") is not None and not isinstance(route["slo_seconds"], (int, float)):
+                raise ValueError(f"route '{task}' slo_seconds must be a number")
+    except ValueError as e:
+        print(f"Ignoring BOOKFORGE_MODEL_ROUTES: {str(e)}")
+        return
+    MODEL_ROUTES.clear()
+    MODEL_ROUTES.update(routes)
+
+apply_route_overrides(os.getenv("BOOKFORGE_MODEL_ROUTES", ""))
+
+# Preload the model client, fonts and DOCX template at startup. Useful on
+# long-lived hosts; leave off on serverless where cold starts should stay cheap.
+BOOKFORGE_WARMUP = os.getenv("BOOKFORGE_WARMUP", "").lower() in ("1", "true", "yes")
+
+@lru_cache(maxsize=1)
+def get_genai():
+    """Import and configure the Gemini SDK on first use"""
+    import google.generativeai as genai
+    if GEMINI_API_KEY:
+        genai.configure(api_key=GEMINI_API_KEY)
+    return genai
+
+@lru_cache(maxsize=None)
+def get_gemini_model(model_name: str = GEMINI_MODEL):
+    """Build each Gemini model client once and reuse it across calls"""
+    genai = get_genai()
+    return genai.GenerativeModel(
+        model_name=model_name,
+        generation_config={
+            "temperature": 0.7,
+            "top_k": 40,
+            "top_p": 0.95,
+            "max_output_tokens": 4096,
+        },
+        safety_settings=[
+            {
+                "category": "HARM_CATEGORY_HARASSMENT",
+                "threshold": "BLOCK_NONE"
+            },
+            {
+                "category": "HARM_CATEGORY_HATE_SPEECH",
+                "threshold": "BLOCK_NONE"
+            },
+            {
+                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                "threshold": "BLOCK_NONE"
+            },
+            {
+                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+                "threshold": "BLOCK_NONE"
+            }
+        ]
+    )
 
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+@lru_cache(maxsize=1)
+def get_image_fonts():
+    """Load the image fonts once, falling back to PIL's default font"""
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype("arial.ttf", 28), ImageFont.truetype("arial.ttf", 16)
+    except Exception:
+        return ImageFont.load_default(), ImageFont.load_default()
+
+@lru_cache(maxsize=1)
+def get_docx_template() -> bytes:
+    """Blank DOCX with the Times New Roman styles applied, saved once as bytes"""
+    from docx import Document
+    from docx.shared import Pt
+    
+    doc = Document()
+    
+    # Set default font to Times New Roman for all styles
+    for style in doc.styles:
+        try:
+            style.font.name = 'Times New Roman'
+        except:
+            pass
+    
+    # Set Normal style
+    normal_style = doc.styles['Normal']
+    normal_style.font.name = 'Times New Roman'
+    normal_style.font.size = Pt(12)
+    
+    bytes_io = io.BytesIO()
+    doc.save(bytes_io)
+    return bytes_io.getvalue()
+
+def warm_up():
+    """Preload heavy dependencies so the first real request is fast"""
+    if GEMINI_API_KEY:
+        for route in MODEL_ROUTES.values():
+            get_gemini_model(route["model"])
+            if route.get("fallback_model"):
+                get_gemini_model(route["fallback_model"])
+    get_image_fonts()
+    get_docx_template()
+    import fpdf  # noqa: F401
+
+@app.on_event("startup")
+async def startup_warm_up():
+    if BOOKFORGE_WARMUP:
+        try:
+            warm_up()
+        except Exception as e:
+            print(f"Warm-up error: {str(e)}")
 
 class TopicRequest(BaseModel):
     topic: str
+    reuse_similar: bool = True
 
 class OutlineRequest(BaseModel):
     outline: Dict[str, Any]
@@ -51,57 +397,382 @@ class BookEditRequest(BaseModel):
 class ExportRequest(BaseModel):
     book: Dict[str, Any]
     format: str = "docx"
+    illustrated: bool = False
 
 class EditOutlineRequest(BaseModel):
     outline: Dict[str, Any]
     changes: Dict[str, Any]
 
-def call_gemini_api(prompt: str, max_retries: int = 3) -> str:
+class BatchTopicRequest(BaseModel):
+    topics: List[str]
+    reuse_similar: bool = True
+
+# Counters exposed by /metrics
+METRICS: Dict[str, int] = {
+    "outline_requests": 0,
+    "outline_parsed": 0,
+    "outline_repaired": 0,
+    "outline_parse_failures": 0,
+    "outline_retries": 0,
+    "singleflight_leaders": 0,
+    "singleflight_coalesced": 0,
+    "gemini_calls": 0,
+    "hedges_sent": 0,
+    "hedge_wins": 0,
+    "deadline_exceeded": 0,
+    "client_disconnects": 0,
+    "cancelled_generations": 0,
+    "slo_fallbacks": 0,
+    "topic_index_reuses": 0,
+    "topic_index_seeds": 0,
+    "continuity_digests": 0,
+    "continuity_outline_fallbacks": 0,
+}
+
+# How often a waiting endpoint checks whether its client is still connected
+DISCONNECT_POLL_SECONDS = 1.0
+
+class Deadline:
+    """Time budget and cancellation flag shared with worker threads"""
+    
+    def __init__(self, seconds: Optional[float] = None):
+        self.expires_at = time.monotonic() + seconds if seconds is not None else None
+        self._cancelled = threading.Event()
+    
+    @classmethod
+    def from_header(cls, value: Optional[str]) -> "Deadline":
+        try:
+            seconds = float(value) if value else None
+        except ValueError:
+            seconds = None
+        return cls(seconds if seconds is not None and seconds > 0 else None)
+    
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+    
+    def cancel(self) -> None:
+        self._cancelled.set()
+    
+    def extend_to(self, other: "Deadline") -> None:
+        if self.expires_at is None or other.expires_at is None:
+            self.expires_at = None
+        else:
+            self.expires_at = max(self.expires_at, other.expires_at)
+    
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+    
+    def expired(self) -> bool:
+        return self.cancelled or self.remaining() == 0.0
+    
+    def check(self, stage: str) -> None:
+        if self.cancelled:
+            raise HTTPException(status_code=499, detail=f"Client disconnected during {stage}")
+        if self.remaining() == 0.0:
+            METRICS["deadline_exceeded"] += 1
+            raise HTTPException(status_code=504, detail=f"Deadline exceeded during {stage}")
+
+class SingleFlight:
+    """Share one in-flight computation between concurrent identical requests.
+    
+    The shared work gets its own Deadline, extended to the latest deadline of
+    any caller and cancelled once every caller has gone away.
+    """
+    
+    def __init__(self):
+        self._inflight: Dict[Any, Dict[str, Any]] = {}
+    
+    async def do(self, key: Any, fn: Callable[[Deadline], Awaitable[Any]],
+                 deadline: Optional[Deadline] = None) -> Any:
+        deadline = deadline or Deadline()
+        entry = self._inflight.get(key)
+        if entry is None:
+            METRICS["singleflight_leaders"] += 1
+            shared = Deadline()
+            shared.expires_at = deadline.expires_at
+            task = asyncio.ensure_future(fn(shared))
+            entry = {"task": task, "deadline": shared, "waiters": 0}
+            self._inflight[key] = entry
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            METRICS["singleflight_coalesced"] += 1
+            entry["deadline"].extend_to(deadline)
+        
+        entry["waiters"] += 1
+        try:
+            # Shield so one caller going away doesn't cancel the shared work
+            return await asyncio.shield(entry["task"])
+        finally:
+            entry["waiters"] -= 1
+            if entry["waiters"] == 0 and not entry["task"].done():
+                METRICS["cancelled_generations"] += 1
+                entry["deadline"].cancel()
+                # Later identical requests must start fresh, not join cancelled work
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+    
+    def _forget(self, key: Any, task: asyncio.Future) -> None:
+        entry = self._inflight.get(key)
+        if entry is not None and entry["task"] is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every caller left
+
+async def await_unless_disconnected(request: Request, awaitable: Awaitable[Any]) -> Any:
+    """Await the result, giving up as soon as the client disconnects"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                METRICS["client_disconnects"] += 1
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        task.cancel()
+
+async def run_generation(fn: Callable[..., Any], *args: Any) -> Any:
+    """Run a blocking generation job in the threadpool once a slot is free"""
+    async with generation_slots:
+        return await run_in_threadpool(fn, *args)
+
+generation_flight = SingleFlight()
+
+# Response schema for Gemini's JSON mode, matching the outline shape
+OUTLINE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "title": {"type": "STRING"},
+        "chapters": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "chapter_number": {"type": "INTEGER"},
+                    "title": {"type": "STRING"},
+                    "sections": {"type": "ARRAY", "items": {"type": "STRING"}},
+                },
+                "required": ["chapter_number", "title", "sections"],
+            },
+        },
+    },
+    "required": ["title", "chapters"],
+}
+
+OUTLINE_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": OUTLINE_SCHEMA,
+}
+
+class LatencyTracker:
+    """Rolling window of recent call latencies, in seconds"""
+    
+    def __init__(self, window: int = 500):
+        self._samples: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+    
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+    
+    def count(self) -> int:
+        return len(self._samples)
+    
+    def samples(self) -> List[float]:
+        with self._lock:
+            return list(self._samples)
+    
+    def percentile(self, p: float) -> Optional[float]:
+        return sample_percentile(self.samples(), p)
+
+def sample_percentile(samples: List[float], p: float) -> Optional[float]:
+    """Nearest-rank percentile of a list of latencies; None if it is empty"""
+    samples = sorted(samples)
+    if not samples:
+        return None
+    index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+    return samples[index]
+
+# Hedging: if a Gemini call is still running after the GEMINI_HEDGE_PERCENTILE
+# latency of recent calls on the same route, send a duplicate and keep
+# whichever finishes first.
+# GEMINI_HEDGE_BUDGET caps hedges as a fraction of all calls.
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "").lower() in ("1", "true", "yes")
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "95"))
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+GEMINI_HEDGE_BUDGET = float(os.getenv("GEMINI_HEDGE_BUDGET", "0.05"))
+
+# Latency of each individual attempt (drives the hedge delay) and the latency
+# callers actually saw after hedging
+gemini_attempt_latency = LatencyTracker()
+gemini_call_latency = LatencyTracker()
+# Shared cap on concurrent Gemini requests across all endpoints. Outline jobs
+# also wait on generation_slots on the event loop, so a big batch queues
+# without tying up threadpool workers other endpoints need.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+gemini_slots = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+generation_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="gemini-hedge")
+hedge_lock = threading.Lock()
+
+def acquire_hedge_budget() -> bool:
+    with hedge_lock:
+        if METRICS["hedges_sent"] + 1 > GEMINI_HEDGE_BUDGET * METRICS["gemini_calls"]:
+            return False
+        METRICS["hedges_sent"] += 1
+        return True
+
+# Attempt latency per "task:model" route, used by hedging and SLO routing. A
+# 60-word digest and a full chapter take very different times, so each route
+# learns its own hedge delay and SLO percentile.
+route_latency: Dict[str, LatencyTracker] = {}
+route_lock = threading.Lock()
+# Calls per "task:model" route, and per-task count of over-SLO decisions
+ROUTE_COUNTS: Dict[str, int] = {}
+slo_breaches: Dict[str, int] = {}
+
+# While the primary is over its SLO, still send every Nth call to it so its
+# latency keeps being measured and the route can recover
+ROUTE_SLO_PERCENTILE = 95
+ROUTE_MIN_SAMPLES = 10
+ROUTE_PROBE_EVERY = 10
+
+def get_route_latency(task: str, model_name: str) -> LatencyTracker:
+    with route_lock:
+        return route_latency.setdefault(f"{task}:{model_name}", LatencyTracker())
+
+def model_latency_samples(model_name: str) -> List[float]:
+    """Recent attempt latencies of a model across every route that uses it,
+    for /metrics"""
+    with route_lock:
+        trackers = [tracker for key, tracker in route_latency.items()
+                    if key.split(":", 1)[1] == model_name]
+    return [sample for tracker in trackers for sample in tracker.samples()]
+
+def select_route(task: str) -> tuple:
+    """Pick the model for a task; returns (model name, generation config)"""
+    route = MODEL_ROUTES.get(task) or MODEL_ROUTES["chapter"]
+    model_name = route["model"]
+    fallback = route.get("fallback_model")
+    slo = route.get("slo_seconds")
+    if fallback and slo:
+        # Judge the SLO on this task's own calls; other tasks on the same
+        # model would skew the percentile
+        tracker = get_route_latency(task, model_name)
+        observed = tracker.percentile(ROUTE_SLO_PERCENTILE)
+        if tracker.count() >= ROUTE_MIN_SAMPLES and observed > slo:
+            with route_lock:
+                slo_breaches[task] = slo_breaches.get(task, 0) + 1
+                probe = slo_breaches[task] % ROUTE_PROBE_EVERY == 0
+            if not probe:
+                METRICS["slo_fallbacks"] += 1
+                model_name = fallback
+    with route_lock:
+        key = f"{task}:{model_name}"
+        ROUTE_COUNTS[key] = ROUTE_COUNTS.get(key, 0) + 1
+    return model_name, dict(route.get("generation_config", {}))
+
+def timed_attempt(fn: Callable[[], Any], tracker: LatencyTracker) -> Any:
+    """Run one attempt that already holds a gemini_slots slot, timing only
+    the upstream call, and release the slot when it finishes"""
+    start = time.perf_counter()
+    try:
+        return fn()
+    finally:
+        elapsed = time.perf_counter() - start
+        gemini_slots.release()
+        gemini_attempt_latency.record(elapsed)
+        tracker.record(elapsed)
+
+def call_with_hedge(fn: Callable[[], Any], tracker: LatencyTracker) -> Any:
+    """Run fn, firing one duplicate if it runs past the learned hedge delay"""
+    METRICS["gemini_calls"] += 1
+    # Queueing for a slot is local wait, not model latency: start timing after
+    gemini_slots.acquire()
+    start = time.perf_counter()
+    try:
+        delay = None
+        if GEMINI_HEDGE_ENABLED and tracker.count() >= GEMINI_HEDGE_MIN_SAMPLES:
+            delay = tracker.percentile(GEMINI_HEDGE_PERCENTILE)
+        if delay is None:
+            return timed_attempt(fn, tracker)
+        
+        primary = hedge_executor.submit(timed_attempt, fn, tracker)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        # Only hedge into free capacity; a hedge that has to queue can't win
+        if not gemini_slots.acquire(blocking=False):
+            return primary.result()
+        if not acquire_hedge_budget():
+            gemini_slots.release()
+            return primary.result()
+        
+        hedge = hedge_executor.submit(timed_attempt, fn, tracker)
+        pending = {primary, hedge}
+        first_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # The SDK call is blocking, so a loser that already started
+                    # can't be interrupted; its result is simply dropped.
+                    for loser in pending:
+                        if loser.cancel():
+                            gemini_slots.release()
+                    if future is hedge:
+                        METRICS["hedge_wins"] += 1
+                    return future.result()
+                first_error = first_error or future.exception()
+        raise first_error
+    finally:
+        gemini_call_latency.record(time.perf_counter() - start)
+
+def generate_text(prompt: str, model_name: str, generation_config: Optional[Dict[str, Any]],
+                  timeout: Optional[float] = None) -> Optional[str]:
+    """One Gemini request; returns None on an empty or blocked response"""
+    model = get_gemini_model(model_name)
+    
+    response = model.generate_content(
+        contents=prompt,
+        generation_config=generation_config,
+        stream=False,
+        request_options={"timeout": timeout} if timeout else None
+    )
+    
+    if response.candidates and len(response.candidates) > 0:
+        candidate = response.candidates[0]
+        if candidate.content and candidate.content.parts:
+            if hasattr(candidate.content.parts[0], 'text'):
+                text = candidate.content.parts[0].text
+                if text and text.strip():
+                    return text
+    return None
+
+def call_gemini_api(prompt: str, max_retries: int = 3,
+                    generation_config: Optional[Dict[str, Any]] = None,
+                    deadline: Optional[Deadline] = None,
+                    task: str = "chapter") -> str:
     if not GEMINI_API_KEY:
         raise HTTPException(status_code=500, detail="GEMINI_API_KEY not configured")
+    deadline = deadline or Deadline()
     
     for attempt in range(max_retries):
+        deadline.check("Gemini call")
+        timeout = deadline.remaining()
+        model_name, config = select_route(task)
+        config.update(generation_config or {})
         try:
-            model = genai.GenerativeModel(
-                model_name=GEMINI_MODEL,
-                generation_config={
-                    "temperature": 0.7,
-                    "top_k": 40,
-                    "top_p": 0.95,
-                    "max_output_tokens": 4096,
-                },
-                safety_settings=[
-                    {
-                        "category": "HARM_CATEGORY_HARASSMENT",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_HATE_SPEECH",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        "threshold": "BLOCK_NONE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                        "threshold": "BLOCK_NONE"
-                    }
-                ]
+            text = call_with_hedge(
+                lambda: generate_text(prompt, model_name, config, timeout),
+                get_route_latency(task, model_name),
             )
-            
-            response = model.generate_content(
-                contents=prompt,
-                stream=False
-            )
-            
-            if response.candidates and len(response.candidates) > 0:
-                candidate = response.candidates[0]
-                if candidate.content and candidate.content.parts:
-                    if hasattr(candidate.content.parts[0], 'text'):
-                        text = candidate.content.parts[0].text
-                        if text and text.strip():
-                            return text
+            if text:
+                return text
             
             if attempt < max_retries - 1:
                 continue
@@ -112,23 +783,174 @@ def call_gemini_api(prompt: str, max_retries: int = 3) -> str:
             raise
         except Exception as e:
             error_msg = str(e)
+            # An SDK timeout at the deadline is a 504, not an API error
+            deadline.check("Gemini call")
             if attempt < max_retries - 1:
                 continue
             raise HTTPException(status_code=500, detail=f"Gemini API error: {error_msg}")
 
+class IncrementalJSONParser:
+    """Tolerant JSON parser that can be fed partial model output.
+    
+    Text before the first '{' (e.g. a ```json fence) is ignored. The scanner
+    state is kept between feed() calls, so streamed chunks are only scanned
+    once. result() repairs truncated input by cutting back to the last
+    complete element and closing any open brackets.
+    """
+    
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        self.complete = False
+        self.repaired = False
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        # (end index, closers) of the last point the text can be cut at
+        self._cut: Optional[tuple] = None
+    
+    def feed(self, chunk: str) -> None:
+        if self.complete:
+            return
+        if not self.started:
+            start = chunk.find('{')
+            if start == -1:
+                return
+            chunk = chunk[start:]
+            self.started = True
+        self.buffer += chunk
+        self._scan()
+    
+    def _scan(self) -> None:
+        text = self.buffer
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                self._stack.append('}' if ch == '{' else ']')
+                self._cut = (i + 1, tuple(self._stack))
+            elif ch in '}]':
+                if self._stack:
+                    self._stack.pop()
+                if not self._stack:
+                    self.buffer = text[:i + 1]
+                    self.complete = True
+                    self._pos = i + 1
+                    return
+                self._cut = (i + 1, tuple(self._stack))
+            elif ch == ',':
+                self._cut = (i, tuple(self._stack))
+        self._pos = len(text)
+    
+    def result(self) -> Optional[Any]:
+        """Best-effort parse of everything fed so far, or None"""
+        if not self.started:
+            return None
+        try:
+            value = json.loads(self.buffer)
+            self.repaired = False
+            return value
+        except ValueError:
+            pass
+        if self.complete or self._cut is None:
+            return None
+        end, closers = self._cut
+        repaired_text = self.buffer[:end] + ''.join(reversed(closers))
+        try:
+            value = json.loads(repaired_text)
+        except ValueError:
+            return None
+        self.repaired = True
+        return value
+
+def normalize_outline(data: Any) -> Optional[Dict[str, Any]]:
+    """Coerce parsed model output into the outline shape, or None if unusable"""
+    if not isinstance(data, dict):
+        return None
+    chapters = []
+    for chapter in data.get("chapters") or []:
+        if not isinstance(chapter, dict):
+            continue
+        title = chapter.get("title")
+        if not isinstance(title, str) or not title.strip():
+            continue
+        sections = [s for s in chapter.get("sections") or [] if isinstance(s, str) and s.strip()]
+        if not sections:
+            continue
+        chapters.append({
+            "chapter_number": len(chapters) + 1,
+            "title": title.strip(),
+            "sections": sections,
+        })
+    if not chapters:
+        return None
+    title = data.get("title")
+    if not isinstance(title, str) or not title.strip():
+        return None
+    return {"title": title.strip(), "chapters": chapters}
+
+# A repaired (truncated) outline is only usable if this many chapters survived
+MIN_REPAIRED_CHAPTERS = 3
+
+def parse_outline(response_text: str) -> tuple:
+    """Parse and validate an outline from model output, repairing truncation.
+    Returns (outline or None, whether the outline was repaired)."""
+    parser = IncrementalJSONParser()
+    parser.feed(response_text)
+    outline = normalize_outline(parser.result())
+    if outline is not None and parser.repaired and len(outline["chapters"]) < MIN_REPAIRED_CHAPTERS:
+        outline = None
+    if outline is None:
+        METRICS["outline_parse_failures"] += 1
+    elif parser.repaired:
+        METRICS["outline_repaired"] += 1
+    else:
+        METRICS["outline_parsed"] += 1
+    return outline, outline is not None and parser.repaired
+
 def generate_image_with_imagen(prompt: str) -> Optional[bytes]:
     """Generate image using PIL with professional design"""
     try:
-        return generate_professional_image(prompt)
+        image = generate_professional_image(prompt)
+        if image:
+            return image
     except Exception as e:
         print(f"Image generation error: {str(e)}")
-        # Fallback to simple placeholder
-        return generate_simple_image(prompt)
+    # Fallback to simple placeholder
+    return generate_simple_image(prompt)
+
+# Illustrated exports render images on this pool while the text is laid out
+EXPORT_IMAGE_WORKERS = int(os.getenv("BOOKFORGE_IMAGE_WORKERS", "4"))
+image_executor = ThreadPoolExecutor(max_workers=EXPORT_IMAGE_WORKERS, thread_name_prefix="export-image")
+
+def illustration_prompts(book: Dict[str, Any], max_chapters: Optional[int] = None) -> tuple:
+    """Prompts for the cover and each chapter image, as (cover, [chapter, ...])"""
+    chapters = book.get("chapters", [])[:max_chapters] if max_chapters else book.get("chapters", [])
+    cover = book.get("title", "Untitled Book")
+    return cover, [chapter.get("title", f"Chapter {idx}") for idx, chapter in enumerate(chapters, 1)]
+
+@lru_cache(maxsize=256)
+def cached_illustration(prompt: str) -> Optional[bytes]:
+    """Rendered images are kept so re-exporting a book (e.g. DOCX then PDF) is free"""
+    return generate_image_with_imagen(prompt)
+
+def start_illustrations(prompts: List[str]) -> Dict[str, Any]:
+    """Start rendering one image per distinct prompt; returns prompt -> Future"""
+    return {prompt: image_executor.submit(cached_illustration, prompt) for prompt in dict.fromkeys(prompts)}
 
 def generate_professional_image(prompt: str) -> bytes:
     """Generate a professional looking image with gradient background and shapes"""
-    from PIL import ImageDraw, ImageFont
-    import random
+    from PIL import Image as PILImage, ImageDraw
     
     try:
         # Create image with professional size
@@ -145,9 +967,10 @@ def generate_professional_image(prompt: str) -> bytes:
         ]
         
         # Random selection for variety
-        random.seed(hash(prompt) % (2**32))
-        primary_color = random.choice(colors[:2])
-        secondary_color = random.choice(colors[2:])
+        # Own generator so concurrent renders don't share the global seed
+        rng = random.Random(hash(prompt) % (2**32))
+        primary_color = rng.choice(colors[:2])
+        secondary_color = rng.choice(colors[2:])
         
         # Draw gradient-like background
         for y in range(height):
@@ -173,12 +996,7 @@ def generate_professional_image(prompt: str) -> bytes:
                       fill=(76, 175, 80, 60))
         
         # Add text centered
-        try:
-            font = ImageFont.truetype("arial.ttf", 28)
-            font_small = ImageFont.truetype("arial.ttf", 16)
-        except:
-            font = ImageFont.load_default()
-            font_small = ImageFont.load_default()
+        font, font_small = get_image_fonts()
         
         # Prepare text
         text_lines = prompt.split()
@@ -216,7 +1034,7 @@ def generate_professional_image(prompt: str) -> bytes:
 
 def generate_simple_image(prompt: str) -> bytes:
     """Generate a simple fallback image"""
-    from PIL import ImageDraw
+    from PIL import Image as PILImage, ImageDraw
     
     try:
         width, height = 600, 400
@@ -244,9 +1062,241 @@ def generate_simple_image(prompt: str) -> bytes:
         print(f"Simple image error: {str(e)}")
         return None
 
-@app.post("/generate_outline")
-async def generate_outline(request: TopicRequest):
-    prompt = f"""Generate a detailed book outline for the topic: "{request.topic}"
+# Server-side storage for the topic index (and other persisted state)
+BOOKFORGE_DATA_DIR = os.getenv("BOOKFORGE_DATA_DIR", os.path.join(tempfile.gettempdir(), "bookforge"))
+# A stored outline is returned as-is only when the canonical topics match or
+# similarity reaches the reuse threshold; from the seed threshold up it is
+# passed to the model as a starting point instead
+TOPIC_REUSE_THRESHOLD = float(os.getenv("BOOKFORGE_TOPIC_REUSE_THRESHOLD", "0.95"))
+TOPIC_SEED_THRESHOLD = float(os.getenv("BOOKFORGE_TOPIC_SEED_THRESHOLD", "0.5"))
+
+def canonical_topic(topic: str) -> str:
+    """Fold case, accents, punctuation and a leading article so "the future
+    of A.I." == "Future of AI"; "+" and "#" are kept, so C++ != C# != C"""
+    text = unicodedata.normalize("NFKD", topic)
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    text = re.sub(r"[.'\u2019]", "", text)
+    text = re.sub(r"[^\w+#]+", " ", text)
+    words = text.split()
+    if len(words) > 1 and words[0] in ("the", "a", "an"):
+        words = words[1:]
+    return " ".join(words)
+
+class TopicIndex:
+    """MinHash/LSH index over character shingles of previously outlined topics.
+    
+    Each outline is indexed under its topic and its title. Lookups only score
+    entries sharing an LSH band with the query, then report the exact Jaccard
+    similarity of the shingle sets. Entries (with their signatures, so reloads
+    don't recompute them) are appended to a JSONL file to survive restarts.
+    """
+    
+    NUM_HASHES = 64
+    BANDS = 32
+    SHINGLE_SIZE = 3
+    
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._entries: List[Dict[str, Any]] = []
+        self._shingles: List[frozenset] = []
+        self._keys: List[str] = []
+        self._buckets: Dict[tuple, List[int]] = {}
+        # XOR with a fixed random mask permutes the 64-bit hash space; much
+        # cheaper in Python than (a * h + b) mod p
+        rng = random.Random(1234)
+        self._masks = [rng.getrandbits(64) for _ in range(self.NUM_HASHES)]
+    
+    def shingles(self, text: str) -> frozenset:
+        padded = f" {text} "
+        size = self.SHINGLE_SIZE
+        return frozenset(padded[i:i + size] for i in range(max(1, len(padded) - size + 1)))
+    
+    def signature(self, shingles: frozenset) -> List[int]:
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+                  for s in shingles]
+        return [min([h ^ mask for h in hashes]) for mask in self._masks]
+    
+    def _bands(self, signature: List[int]) -> List[tuple]:
+        rows = self.NUM_HASHES // self.BANDS
+        return [(band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(self.BANDS)]
+    
+    def _insert(self, entry: Dict[str, Any]) -> None:
+        signatures = entry.setdefault("signatures", {})
+        for key in {canonical_topic(entry["topic"]), canonical_topic(entry["outline"].get("title", ""))}:
+            if not key:
+                continue
+            shingles = self.shingles(key)
+            if key not in signatures:
+                signatures[key] = self.signature(shingles)
+            index = len(self._shingles)
+            self._entries.append(entry)
+            self._shingles.append(shingles)
+            self._keys.append(key)
+            for band in self._bands(signatures[key]):
+                self._buckets.setdefault(band, []).append(index)
+    
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    self._insert(json.loads(line))
+                except (ValueError, KeyError, AttributeError):
+                    continue
+    
+    def add(self, topic: str, outline: Dict[str, Any]) -> None:
+        entry = {"topic": topic, "outline": outline}
+        with self._lock:
+            self._load()
+            self._insert(entry)
+            if self.path:
+                try:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(entry) + "\n")
+                except OSError as e:
+                    print(f"Topic index write error: {str(e)}")
+    
+    def lookup(self, topic: str) -> Optional[tuple]:
+        """Best match as (score, entry, exact), or None if nothing shares a band.
+        exact is True when the canonical forms of the two topics are identical."""
+        key = canonical_topic(topic)
+        if not key:
+            return None
+        shingles = self.shingles(key)
+        with self._lock:
+            self._load()
+            candidates = set()
+            for band in self._bands(self.signature(shingles)):
+                candidates.update(self._buckets.get(band, ()))
+            best = None
+            for index in candidates:
+                other = self._shingles[index]
+                score = len(shingles & other) / len(shingles | other)
+                exact = self._keys[index] == key
+                if best is None or (exact, score) > (best[2], best[0]):
+                    best = (score, self._entries[index], exact)
+        if best is None:
+            return None
+        score, entry, exact = best
+        return score, {"topic": entry["topic"], "outline": entry["outline"]}, exact
+
+topic_index = TopicIndex(os.path.join(BOOKFORGE_DATA_DIR, "topics.jsonl"))
+
+class SearchIndex:
+    """SQLite FTS5 index of chapter text, updated one chapter at a time as
+    chapters are generated or edited"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+    
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS chapters USING fts5("
+                "book_id UNINDEXED, chapter_number UNINDEXED, book_title, chapter_title, content, "
+                "tokenize='porter unicode61')"
+            )
+            # FTS5 can only filter UNINDEXED columns by scanning every row, so
+            # replacing a chapter looks up its rowid here instead
+            new_table = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chapter_rows'"
+            ).fetchone() is None
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chapter_rows ("
+                "book_id TEXT, chapter_number INTEGER, row INTEGER, "
+                "PRIMARY KEY (book_id, chapter_number))"
+            )
+            if new_table:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO chapter_rows (book_id, chapter_number, row) "
+                        "SELECT book_id, chapter_number, rowid FROM chapters ORDER BY rowid"
+                    )
+            self._conn = conn
+        return self._conn
+    
+    def index_chapter(self, book: Dict[str, Any], chapter: Dict[str, Any]) -> None:
+        with self._lock:
+            conn = self._connect()
+            key = (book["book_id"], chapter.get("chapter_number"))
+            with conn:
+                previous = conn.execute(
+                    "SELECT row FROM chapter_rows WHERE book_id = ? AND chapter_number = ?", key
+                ).fetchone()
+                if previous:
+                    conn.execute("DELETE FROM chapters WHERE rowid = ?", previous)
+                row = conn.execute(
+                    "INSERT INTO chapters (book_id, chapter_number, book_title, chapter_title, content) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (*key, book.get("title", ""), chapter.get("title", ""), chapter.get("content", "")),
+                ).lastrowid
+                conn.execute(
+                    "INSERT OR REPLACE INTO chapter_rows (book_id, chapter_number, row) VALUES (?, ?, ?)",
+                    (*key, row),
+                )
+    
+    @staticmethod
+    def _match_query(query: str) -> str:
+        # Quote every term so user input can't hit FTS5 query syntax errors
+        terms = re.findall(r"\w+", query)
+        return " ".join(f'"{term}"' for term in terms)
+    
+    def search(self, query: str, page: int, page_size: int) -> Dict[str, Any]:
+        match = self._match_query(query)
+        if not match:
+            return {"total": 0, "results": []}
+        with self._lock:
+            conn = self._connect()
+            total = conn.execute(
+                "SELECT count(*) FROM chapters WHERE chapters MATCH ?", (match,)
+            ).fetchone()[0]
+            # bm25 weights: titles count for more than body text
+            rows = conn.execute(
+                "SELECT book_id, chapter_number, book_title, chapter_title, "
+                "snippet(chapters, 4, '**', '**', '...', 16), "
+                "bm25(chapters, 0, 0, 5.0, 3.0, 1.0) AS rank "
+                "FROM chapters WHERE chapters MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+                (match, page_size, (page - 1) * page_size),
+            ).fetchall()
+        return {
+            "total": total,
+            "results": [
+                {
+                    "book_id": book_id,
+                    "chapter_number": chapter_number,
+                    "book_title": book_title,
+                    "chapter_title": chapter_title,
+                    "snippet": snippet,
+                    "score": round(-rank, 4),
+                }
+                for book_id, chapter_number, book_title, chapter_title, snippet, rank in rows
+            ],
+        }
+
+search_index = SearchIndex(os.path.join(BOOKFORGE_DATA_DIR, "search.db"))
+
+def index_chapter(book: Dict[str, Any], chapter: Dict[str, Any]) -> None:
+    """Add or replace a chapter in the search index; indexing never fails a request"""
+    try:
+        search_index.index_chapter(book, chapter)
+    except Exception as e:
+        print(f"Search index error: {str(e)}")
+
+def build_outline(topic: str, deadline: Optional[Deadline] = None,
+                  seed: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    prompt = f"""Generate a detailed book outline for the topic: "{topic}"
 
 Please structure the response as a JSON object with the following format:
 {{
@@ -261,63 +1311,160 @@ Please structure the response as a JSON object with the following format:
 }}
 
 Generate 5-8 chapters with 3-4 sections each. Ensure the outline is logical and comprehensive."""
+    if seed:
+        prompt += f"""
+
+An outline already exists for the closely related topic "{seed['topic']}". Use it as a starting point and adapt it to this topic:
+{json.dumps(seed['outline'])}"""
     
-    try:
-        response_text = call_gemini_api(prompt)
-        
-        json_start = response_text.find('{')
-        json_end = response_text.rfind('}') + 1
-        if json_start != -1 and json_end > json_start:
-            json_str = response_text[json_start:json_end]
-            outline = json.loads(json_str)
-        else:
-            outline = {
-                "title": f"Comprehensive Guide to {request.topic}",
-                "chapters": [
-                    {
-                        "chapter_number": i,
-                        "title": f"Chapter {i}: Introduction to {request.topic}",
-                        "sections": ["Overview", "Key Concepts", "Practical Applications"]
-                    }
-                    for i in range(1, 6)
-                ]
-            }
-        
-        return {
-            "status": "success",
-            "outline": outline
+    METRICS["outline_requests"] += 1
+    # One retry when the reply can't be parsed into a usable outline
+    for attempt in range(2):
+        if attempt:
+            METRICS["outline_retries"] += 1
+        response_text = call_gemini_api(prompt, generation_config=OUTLINE_GENERATION_CONFIG,
+                                        deadline=deadline, task="outline")
+        outline, repaired = parse_outline(response_text)
+        if outline is not None:
+            break
+    
+    if outline is not None:
+        # Repaired outlines are usable once but too lossy to reuse for other topics
+        if not repaired:
+            topic_index.add(topic, outline)
+    else:
+        outline = {
+            "title": f"Comprehensive Guide to {topic}",
+            "chapters": [
+                {
+                    "chapter_number": i,
+                    "title": f"Chapter {i}: Introduction to {topic}",
+                    "sections": ["Overview", "Key Concepts", "Practical Applications"]
+                }
+                for i in range(1, 6)
+            ]
         }
+    return outline
+
+# Chapters written at once per book; later chapters fall back to outline
+# summaries for earlier ones that haven't finished yet
+CHAPTER_CONCURRENCY = int(os.getenv("BOOKFORGE_CHAPTER_CONCURRENCY", "3"))
+# How long a chapter waits for the previous chapter's digest before writing
+# with an outline summary instead; chapters that overrun it overlap the next
+CONTINUITY_WAIT_SECONDS = float(os.getenv("BOOKFORGE_CONTINUITY_WAIT_SECONDS", "30"))
+# Continuity context: digests of at most this many preceding chapters, each
+# capped, so the prompt stays the same size however long the book is
+CONTINUITY_WINDOW = 3
+DIGEST_MAX_CHARS = 400
+
+# Chapter digests keyed by a hash of the chapter text
+digest_cache: "OrderedDict[str, str]" = OrderedDict()
+digest_lock = threading.Lock()
+DIGEST_CACHE_SIZE = 512
+
+def outline_summary(chapter: Dict[str, Any]) -> str:
+    """Stand-in digest built from the outline for a chapter not yet written"""
+    sections = [str(section) for section in chapter.get("sections", [])]
+    summary = f"Planned to cover: {', '.join(sections)}." if sections else "Not yet written."
+    return summary[:DIGEST_MAX_CHARS]
+
+def chapter_digest(chapter_title: str, content: str, deadline: Deadline) -> Optional[str]:
+    """Short digest of a finished chapter, cached by content; None if it can't be made"""
+    key = hashlib.sha1(f"{chapter_title}\n{content}".encode("utf-8")).hexdigest()
+    with digest_lock:
+        if key in digest_cache:
+            digest_cache.move_to_end(key)
+            return digest_cache[key]
     
+    prompt = f"""Summarize this book chapter in at most 60 words for the author of the following chapters. State the key ideas, examples and terms it already covers so they are not repeated. Plain prose, no preamble.
+
+Chapter Title: {chapter_title}
+
+{content}"""
+    try:
+        digest = " ".join(call_gemini_api(prompt, max_retries=1, deadline=deadline, task="summary").split())
     except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating outline: {str(e)}")
+        return None
+    digest = digest[:DIGEST_MAX_CHARS]
+    with digest_lock:
+        digest_cache[key] = digest
+        while len(digest_cache) > DIGEST_CACHE_SIZE:
+            digest_cache.popitem(last=False)
+    return digest
 
-@app.post("/generate_book")
-async def generate_book(request: OutlineRequest):
-    outline = request.outline
-    
-    if "chapters" not in outline:
-        raise HTTPException(status_code=400, detail="Invalid outline structure")
+def continuity_context(chapters: List[Dict[str, Any]], position: int, digests: Dict[int, str]) -> str:
+    """Bounded context for the chapter at position: digests (or outline
+    summaries) of the preceding chapters in the window, plus the next one"""
+    lines = []
+    for prev in range(max(0, position - CONTINUITY_WINDOW), position):
+        chapter = chapters[prev]
+        digest = digests.get(prev)
+        if digest is None:
+            METRICS["continuity_outline_fallbacks"] += 1
+            digest = outline_summary(chapter)
+        lines.append(f"- Earlier chapter \"{chapter.get('title', f'Chapter {prev + 1}')}\": {digest}")
+    if position + 1 < len(chapters):
+        upcoming = chapters[position + 1]
+        lines.append(f"- Next chapter \"{upcoming.get('title', f'Chapter {position + 2}')}\": {outline_summary(upcoming)}")
+    return "\n".join(lines)
+
+def build_book(outline: Dict[str, Any], deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+    """Write the chapters, CHAPTER_CONCURRENCY at a time, each with a compact
+    digest of its neighbours. Each chapter first waits briefly for the previous
+    one's digest. If the deadline passes, the leading run of finished chapters
+    is returned with "incomplete" set; a disconnect aborts the book."""
+    deadline = deadline or Deadline()
     
     book_content = {
+        "book_id": uuid.uuid4().hex,
         "title": outline.get("title", "Untitled Book"),
         "author": "BookForge AI",
         "created_at": datetime.now().isoformat(),
         "chapters": []
     }
+    chapters = outline.get("chapters", [])[:10]
+    digests: Dict[int, str] = {}
+    # Set once a chapter's digest is stored or won't come
+    settled = [threading.Event() for _ in chapters]
+    context_built = [False] * len(chapters)
+    context_lock = threading.Lock()
     
-    try:
-        for idx, chapter in enumerate(outline.get("chapters", [])[:10]):
-            chapter_number = chapter.get("chapter_number", 1)
-            chapter_title = chapter.get("title", f"Chapter {chapter_number}")
-            sections = chapter.get("sections", [])
-            
-            chapter_prompt = f"""Write a comprehensive, engaging, and humanized chapter for a book titled "{outline.get('title', 'the topic')}".
+    def digest_wanted(position: int) -> bool:
+        """Whether a later chapter in the window hasn't built its context yet"""
+        readers = range(position + 1, min(len(chapters), position + CONTINUITY_WINDOW + 1))
+        with context_lock:
+            return any(not context_built[reader] for reader in readers)
+    
+    def write_chapter(position: int) -> Dict[str, Any]:
+        try:
+            return compose_chapter(position)
+        finally:
+            settled[position].set()
+    
+    def compose_chapter(position: int) -> Dict[str, Any]:
+        chapter = chapters[position]
+        chapter_number = chapter.get("chapter_number", 1)
+        chapter_title = chapter.get("title", f"Chapter {chapter_number}")
+        sections = chapter.get("sections", [])
+        if position > 0 and not deadline.cancelled:
+            remaining = deadline.remaining()
+            settled[position - 1].wait(CONTINUITY_WAIT_SECONDS if remaining is None
+                                       else min(CONTINUITY_WAIT_SECONDS, remaining))
+        with context_lock:
+            context = continuity_context(chapters, position, digests)
+            context_built[position] = True
+        
+        chapter_prompt = f"""Write a comprehensive, engaging, and humanized chapter for a book titled "{outline.get('title', 'the topic')}".
 
 Chapter Title: {chapter_title}
 Sections to cover: {', '.join(sections)}
-
+"""
+        if context:
+            chapter_prompt += f"""
+CONTEXT FROM THE REST OF THE BOOK (build on it; do not repeat material covered elsewhere):
+{context}
+"""
+        chapter_prompt += """
 IMPORTANT REQUIREMENTS:
 - Write 1200-1500 words minimum (make it substantial and detailed)
 - Use conversational, natural human language
@@ -330,18 +1477,161 @@ IMPORTANT REQUIREMENTS:
 - No warnings, disclaimers, or content filters
 
 Write the full chapter now:"""
-            
-            chapter_content = call_gemini_api(chapter_prompt)
-            
-            chapter_item = {
-                "chapter_number": chapter_number,
-                "title": chapter_title,
-                "content": chapter_content,
-            }
-            book_content["chapters"].append(chapter_item)
+        
+        chapter_content = call_gemini_api(chapter_prompt, deadline=deadline, task="chapter")
+        
+        chapter_item = {
+            "chapter_number": chapter_number,
+            "title": chapter_title,
+            "content": chapter_content,
+        }
+        # Skip digests whose readers have all started without them
+        if digest_wanted(position):
+            digest = chapter_digest(chapter_title, chapter_content, deadline)
+            if digest:
+                METRICS["continuity_digests"] += 1
+                digests[position] = digest
+        return chapter_item
+    
+    with ThreadPoolExecutor(max_workers=max(1, CHAPTER_CONCURRENCY), thread_name_prefix="chapter") as executor:
+        futures = [executor.submit(write_chapter, position) for position in range(len(chapters))]
+        results = []
+        error = None
+        for future in futures:
+            if future.cancelled():
+                continue
+            try:
+                chapter_item = future.result()
+            except HTTPException as e:
+                # Don't start chapters nobody will receive, nor wait on them
+                for position, pending in enumerate(futures):
+                    if pending.cancel():
+                        settled[position].set()
+                if e.status_code != 504:
+                    error = error or e
+                else:
+                    book_content["incomplete"] = True
+                continue
+            # A partial book stops at its first missing chapter
+            if not book_content.get("incomplete"):
+                results.append(chapter_item)
+        if error:
+            raise error
+    
+    if book_content.get("incomplete") and not results:
+        raise HTTPException(status_code=504, detail="Deadline exceeded before any chapter was written")
+    book_content["chapters"] = results
+    # Only a book that is actually returned becomes searchable
+    for chapter_item in results:
+        index_chapter(book_content, chapter_item)
+    return book_content
+
+def normalize_topic(topic: str) -> str:
+    return " ".join(topic.split()).casefold()
+
+def outline_key(outline: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(outline, sort_keys=True).encode("utf-8")).hexdigest()
+
+async def outline_for_topic(topic: str, deadline: Deadline, reuse_similar: bool = True) -> tuple:
+    """Outline for a topic as (outline, match); match describes any near-duplicate
+    topic whose outline was reused or used as a seed"""
+    seed = None
+    match = None
+    if reuse_similar:
+        # The first lookup loads the index file and add() may hold the lock
+        found = await run_in_threadpool(topic_index.lookup, topic)
+        if found is not None and (found[2] or found[0] >= TOPIC_SEED_THRESHOLD):
+            score, entry, exact = found
+            # Character shingles score e.g. "Organic" vs "Inorganic Chemistry"
+            # at 0.86, so only near-identical topics get an outline verbatim
+            reused = exact or score >= TOPIC_REUSE_THRESHOLD
+            match = {"topic": entry["topic"], "score": round(score, 3), "reused": reused}
+            if reused:
+                METRICS["topic_index_reuses"] += 1
+                return entry["outline"], match
+            METRICS["topic_index_seeds"] += 1
+            seed = entry
+    
+    outline = await generation_flight.do(
+        ("outline", normalize_topic(topic), seed is not None),
+        lambda shared: run_generation(build_outline, topic, shared, seed),
+        deadline,
+    )
+    return outline, match
+
+@app.post("/generate_outline")
+async def generate_outline(request: TopicRequest, http_request: Request,
+                           x_deadline_seconds: Optional[str] = Header(None)):
+    try:
+        outline, match = await await_unless_disconnected(http_request, outline_for_topic(
+            request.topic, Deadline.from_header(x_deadline_seconds), request.reuse_similar,
+        ))
         
         return {
             "status": "success",
+            "outline": outline,
+            "match": match
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating outline: {str(e)}")
+
+MAX_BATCH_TOPICS = 50
+
+@app.post("/generate_outlines")
+async def generate_outlines(request: BatchTopicRequest,
+                            x_deadline_seconds: Optional[str] = Header(None)):
+    """Generate outlines for many topics, streaming NDJSON lines as each finishes"""
+    topics = request.topics
+    if not topics:
+        raise HTTPException(status_code=400, detail="No topics provided")
+    if len(topics) > MAX_BATCH_TOPICS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_TOPICS} topics per batch")
+    deadline = Deadline.from_header(x_deadline_seconds)
+    
+    async def outline_result(index: int, topic: str) -> Dict[str, Any]:
+        result = {"index": index, "topic": topic}
+        if not topic or not topic.strip():
+            return {**result, "status": "error", "detail": "Empty topic"}
+        try:
+            outline, match = await outline_for_topic(topic, deadline, request.reuse_similar)
+            return {**result, "status": "success", "outline": outline, "match": match}
+        except HTTPException as e:
+            return {**result, "status": "error", "detail": e.detail}
+        except Exception as e:
+            return {**result, "status": "error", "detail": f"Error generating outline: {str(e)}"}
+    
+    async def stream():
+        tasks = [asyncio.ensure_future(outline_result(i, t)) for i, t in enumerate(topics)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        finally:
+            # Client went away mid-stream: release our share of the work
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.post("/generate_book")
+async def generate_book(request: OutlineRequest, http_request: Request,
+                        x_deadline_seconds: Optional[str] = Header(None)):
+    outline = request.outline
+    
+    if "chapters" not in outline:
+        raise HTTPException(status_code=400, detail="Invalid outline structure")
+    
+    try:
+        book_content = await await_unless_disconnected(http_request, generation_flight.do(
+            ("book", outline_key(outline)),
+            lambda deadline: run_in_threadpool(build_book, outline, deadline),
+            Deadline.from_header(x_deadline_seconds),
+        ))
+        
+        return {
+            "status": "partial" if book_content.get("incomplete") else "success",
             "book": book_content
         }
     
@@ -362,11 +1652,11 @@ async def export_book(request: ExportRequest):
     
     try:
         if export_format == "docx":
-            file_content = create_docx(book)
+            file_content = await run_in_threadpool(create_docx, book, request.illustrated)
             filename = f"bookforge_{book.get('title', 'untitled').replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
             media_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
         else:
-            file_content = create_pdf(book)
+            file_content = await run_in_threadpool(create_pdf, book, request.illustrated)
             filename = f"bookforge_{book.get('title', 'untitled').replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
             media_type = "application/pdf"
         
@@ -395,6 +1685,13 @@ async def edit_chapter(request: BookEditRequest):
         for chapter in book.get("chapters", []):
             if chapter.get("chapter_number") == chapter_number:
                 chapter["content"] = new_content
+                if not book.get("book_id"):
+                    # Books generated before search existed get an id on first edit
+                    book["book_id"] = uuid.uuid4().hex
+                    for other in book.get("chapters", []):
+                        await run_in_threadpool(index_chapter, book, other)
+                else:
+                    await run_in_threadpool(index_chapter, book, chapter)
                 return {
                     "status": "success",
                     "message": f"Chapter {chapter_number} updated successfully",
@@ -408,6 +1705,23 @@ async def edit_chapter(request: BookEditRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error editing chapter: {str(e)}")
 
+@app.get("/search")
+async def search_books(q: str, page: int = 1, page_size: int = 10):
+    """Ranked full-text search over generated chapters"""
+    if page < 1 or not 1 <= page_size <= 100:
+        raise HTTPException(status_code=400, detail="page must be >= 1 and page_size between 1 and 100")
+    try:
+        results = await run_in_threadpool(search_index.search, q, page, page_size)
+        return {
+            "status": "success",
+            "query": q,
+            "page": page,
+            "page_size": page_size,
+            **results
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching books: {str(e)}")
+
 @app.post("/edit_outline")
 async def edit_outline(request: EditOutlineRequest):
     """Edit the outline"""
@@ -430,23 +1744,21 @@ async def edit_outline(request: EditOutlineRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error editing outline: {str(e)}")
 
-def create_docx(book: Dict[str, Any]) -> bytes:
-    from docx.shared import Pt, RGBColor, Inches
+def create_docx(book: Dict[str, Any], illustrated: bool = False) -> bytes:
+    from docx import Document
+    from docx.shared import Pt, Inches
     from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
     
-    doc = Document()
-    
-    # Set default font to Times New Roman for all styles
-    for style in doc.styles:
-        try:
-            style.font.name = 'Times New Roman'
-        except:
-            pass
+    # Start rendering art first; empty paragraphs mark where each image goes
+    # and are filled in after the text is laid out
+    illustrations = {}
+    image_slots = []
+    if illustrated:
+        cover_prompt, chapter_prompts = illustration_prompts(book)
+        illustrations = start_illustrations([cover_prompt] + chapter_prompts)
     
-    # Set Normal style
-    normal_style = doc.styles['Normal']
-    normal_style.font.name = 'Times New Roman'
-    normal_style.font.size = Pt(12)
+    # Start from the pre-styled template instead of restyling every export
+    doc = Document(io.BytesIO(get_docx_template()))
     
     # Add Title Page
     title = book.get("title", "Untitled Book")
@@ -472,6 +1784,11 @@ def create_docx(book: Dict[str, Any]) -> bytes:
         run.font.name = 'Times New Roman'
         run.font.size = Pt(10)
     
+    if illustrated:
+        cover_para = doc.add_paragraph()
+        cover_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        image_slots.append((cover_para, cover_prompt, Inches(6)))
+    
     doc.add_page_break()
     
     # Add Table of Contents
@@ -497,6 +1814,11 @@ def create_docx(book: Dict[str, Any]) -> bytes:
             run.font.size = Pt(16)
             run.font.bold = True
         
+        if illustrated:
+            image_para = doc.add_paragraph()
+            image_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+            image_slots.append((image_para, chapter_prompts[idx - 1], Inches(5)))
+        
         doc.add_paragraph()  # Spacing
         
         # Add content with proper formatting
@@ -561,16 +1883,42 @@ def create_docx(book: Dict[str, Any]) -> bytes:
         
         doc.add_page_break()
     
+    # python-docx stores identical image bytes as a single part
+    for para, prompt, width in image_slots:
+        image = illustrations[prompt].result()
+        if image:
+            para.add_run().add_picture(io.BytesIO(image), width=width)
+    
     bytes_io = io.BytesIO()
     doc.save(bytes_io)
     bytes_io.seek(0)
     return bytes_io.getvalue()
 
-def create_pdf(book: Dict[str, Any]) -> bytes:
+def create_pdf(book: Dict[str, Any], illustrated: bool = False) -> bytes:
     """Create a properly formatted PDF with Times font and content preservation"""
     from fpdf import FPDF
     
-    pdf = FPDF()
+    illustrations = {}
+    if illustrated:
+        cover_prompt, chapter_prompts = illustration_prompts(book, max_chapters=20)
+        illustrations = start_illustrations([cover_prompt] + chapter_prompts)
+    with tempfile.TemporaryDirectory(prefix="bookforge_images_") as image_dir:
+        return render_pdf(book, FPDF(), illustrations, image_dir)
+
+def pdf_image_path(illustrations: Dict[str, Any], prompt: str, image_dir: str) -> Optional[str]:
+    """Wait for a rendered image and write it to disk once. fpdf embeds each
+    file name only once, so identical images share one copy in the PDF."""
+    future = illustrations.get(prompt)
+    image = future.result() if future else None
+    if not image:
+        return None
+    path = os.path.join(image_dir, hashlib.sha1(image).hexdigest() + ".png")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(image)
+    return path
+
+def render_pdf(book: Dict[str, Any], pdf, illustrations: Dict[str, Any], image_dir: str) -> bytes:
     pdf.set_auto_page_break(auto=True, margin=12)
     
     # Title Page
@@ -591,6 +1939,11 @@ def create_pdf(book: Dict[str, Any]) -> bytes:
     timestamp = f"Created on {datetime.now().strftime('%B %d, %Y')}"
     pdf.cell(0, 8, timestamp, ln=True, align="C")
     
+    cover_path = pdf_image_path(illustrations, book.get("title", "Untitled Book"), image_dir)
+    if cover_path:
+        pdf.ln(10)
+        pdf.image(cover_path, x=25, w=160)
+    
     # Table of Contents
     pdf.add_page()
     pdf.set_font("Times", "B", 14)
@@ -621,6 +1974,11 @@ def create_pdf(book: Dict[str, Any]) -> bytes:
         pdf.cell(0, 4, f"Chapter {idx}", ln=True)
         pdf.ln(2)
         
+        image_path = pdf_image_path(illustrations, chapter_title, image_dir)
+        if image_path:
+            pdf.image(image_path, x=45, w=120)
+            pdf.ln(4)
+        
         # Content with formatting
         pdf.set_font("Times", "", 11)
         content = chapter.get("content", "")
@@ -667,11 +2025,30 @@ def create_pdf(book: Dict[str, Any]) -> bytes:
             pdf.ln(2)
     
     # Output as bytes
-    pdf_output = pdf.output()
+    pdf_output = pdf.output(dest='S')
     if isinstance(pdf_output, str):
         return pdf_output.encode('latin-1', errors='ignore')
     return pdf_output
 
+@app.get("/metrics")
+async def get_metrics():
+    parse_attempts = METRICS["outline_parsed"] + METRICS["outline_repaired"] + METRICS["outline_parse_failures"]
+    return {
+        **METRICS,
+        "outline_parse_failure_rate": (
+            METRICS["outline_parse_failures"] / parse_attempts if parse_attempts else 0.0
+        ),
+        "gemini_attempt_p50": gemini_attempt_latency.percentile(50),
+        "gemini_attempt_p99": gemini_attempt_latency.percentile(99),
+        "gemini_call_p50": gemini_call_latency.percentile(50),
+        "gemini_call_p99": gemini_call_latency.percentile(99),
+        "routes": dict(ROUTE_COUNTS),
+        "model_p95": {
+            name: sample_percentile(model_latency_samples(name), 95)
+            for name in {key.split(":", 1)[1] for key in list(route_latency)}
+        },
+    }
+
 @app.get("/health")
 async def health_check():
     return {
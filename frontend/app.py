@@ -1,10 +1,32 @@
 ﻿import streamlit as st
 import requests
 import json
+import gzip
 import os
 
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 
+def deadline_headers(timeout):
+    # Leave the backend a few seconds to send back what it has before we give up
+    return {"X-Deadline-Seconds": str(max(timeout - 10, 1))}
+
+@st.cache_resource
+def get_session():
+    # One pooled keep-alive session for every backend call, shared across reruns
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+def post_json(path, payload, headers=None, **kwargs):
+    # Gzip large bodies (whole books); the backend decompresses by Content-Encoding
+    body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    headers = {"Content-Type": "application/json", **(headers or {})}
+    if len(body) > 1024:
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return get_session().post(f"{BACKEND_URL}{path}", data=body, headers=headers, **kwargs)
+
 st.set_page_config(page_title="BookForge AI", layout="wide", initial_sidebar_state="collapsed")
 
 st.markdown("""
@@ -115,6 +137,7 @@ with tab1:
     with col1:
         st.write("**Select Writing Style**")
         outline_style = st.selectbox("Outline Style", list(WRITING_STYLES.keys()), format_func=lambda x: f"{x.title()} - {WRITING_STYLES[x]}", label_visibility="collapsed")
+        reuse_similar = st.checkbox("Reuse outlines from similar past topics", value=True, key="reuse_similar")
     with col2:
         if st.button("Generate Outline (8 Chapters)", use_container_width=True, key="generate_outline_btn"):
             if not topic or topic.strip() == "": 
@@ -122,16 +145,45 @@ with tab1:
             else:
                 with st.spinner("Generating outline..."):
                     try:
-                        resp = requests.post(f"{BACKEND_URL}/generate_outline", json={"topic": topic, "outline_style": outline_style}, timeout=120)
+                        resp = post_json("/generate_outline", {"topic": topic, "outline_style": outline_style, "reuse_similar": reuse_similar}, headers=deadline_headers(120), timeout=120)
                         if resp.status_code == 200:
                             st.session_state.outline_data = resp.json().get("outline")
-                            st.markdown("<div class='success-box'>Outline generated successfully!</div>", unsafe_allow_html=True)
-                            st.rerun()
+                            match = resp.json().get("match")
+                            if match and match.get("reused"):
+                                st.markdown(f"<div class='info-box'>Reused the outline for \"{match['topic']}\" (similarity {match['score']:.2f}). Untick reuse to generate a fresh one.</div>", unsafe_allow_html=True)
+                            else:
+                                st.markdown("<div class='success-box'>Outline generated successfully!</div>", unsafe_allow_html=True)
+                                st.rerun()
                         else:
                             st.markdown(f"<div class='error-box'>Error: {resp.json().get('detail', 'Unknown error')}</div>", unsafe_allow_html=True)
                     except Exception as e:
                         st.markdown(f"<div class='error-box'>Error: {str(e)}</div>", unsafe_allow_html=True)
     
+    with st.expander("Batch outlines (one topic per line)"):
+        batch_text = st.text_area("Batch Topics", height=150, key="batch_topics", label_visibility="collapsed")
+        if st.button("Generate Batch Outlines", use_container_width=True, key="generate_batch_btn"):
+            batch_topics = [t.strip() for t in batch_text.splitlines() if t.strip()]
+            if not batch_topics:
+                st.markdown("<div class='error-box'>Please enter at least one topic.</div>", unsafe_allow_html=True)
+            else:
+                try:
+                    with post_json("/generate_outlines", {"topics": batch_topics, "reuse_similar": reuse_similar}, headers=deadline_headers(600), timeout=600, stream=True) as resp:
+                        if resp.status_code != 200:
+                            st.markdown(f"<div class='error-box'>Error: {resp.json().get('detail', 'Unknown error')}</div>", unsafe_allow_html=True)
+                        else:
+                            for line in resp.iter_lines():
+                                if not line:
+                                    continue
+                                item = json.loads(line)
+                                if item.get("status") == "success":
+                                    batch_outline = item["outline"]
+                                    st.write(f"**{item['topic']}:** {batch_outline.get('title', 'Untitled')} ({len(batch_outline.get('chapters', []))} chapters)")
+                                    st.download_button("Download JSON", json.dumps(batch_outline, indent=2), f"outline_{item['index'] + 1}.json", "application/json", key=f"batch_dl_{item['index']}")
+                                else:
+                                    st.markdown(f"<div class='error-box'>{item['topic']}: {item.get('detail', 'Unknown error')}</div>", unsafe_allow_html=True)
+                except Exception as e:
+                    st.markdown(f"<div class='error-box'>Error: {str(e)}</div>", unsafe_allow_html=True)
+    
     if st.session_state.outline_data:
         st.markdown("<div class='section-box'><h2>Your Outline</h2></div>", unsafe_allow_html=True)
         outline = st.session_state.outline_data
@@ -178,11 +230,14 @@ with tab3:
             if st.button("Generate Book (8 Chapters, 1200-1500 words each)", use_container_width=True, key="generate_book_btn"):
                 with st.spinner("Generating book... This will take 3-5 minutes"):
                     try:
-                        resp = requests.post(f"{BACKEND_URL}/generate_book", json={"outline": st.session_state.outline_data, "book_style": book_style}, timeout=600)
+                        resp = post_json("/generate_book", {"outline": st.session_state.outline_data, "book_style": book_style}, headers=deadline_headers(600), timeout=600)
                         if resp.status_code == 200:
                             st.session_state.book_data = resp.json().get("book")
-                            st.markdown("<div class='success-box'>Book generated successfully!</div>", unsafe_allow_html=True)
-                            st.rerun()
+                            if resp.json().get("status") == "partial":
+                                st.markdown("<div class='info-box'>Time ran out before every chapter was written. The finished chapters were kept.</div>", unsafe_allow_html=True)
+                            else:
+                                st.markdown("<div class='success-box'>Book generated successfully!</div>", unsafe_allow_html=True)
+                                st.rerun()
                         else:
                             st.markdown(f"<div class='error-box'>Error: {resp.json().get('detail', 'Unknown error')}</div>", unsafe_allow_html=True)
                     except Exception as e:
@@ -219,7 +274,7 @@ with tab4:
                 with col1:
                     if st.button("Save Changes", use_container_width=True, key="save_chapter_btn"):
                         try:
-                            resp = requests.post(f"{BACKEND_URL}/edit_chapter", json={"book": book, "chapter_number": ch_num, "new_content": edited}, timeout=30)
+                            resp = post_json("/edit_chapter", {"book": book, "chapter_number": ch_num, "new_content": edited}, timeout=30)
                             if resp.status_code == 200:
                                 st.session_state.book_data = resp.json().get("book")
                                 st.markdown("<div class='success-box'>Changes saved!</div>", unsafe_allow_html=True)
@@ -237,11 +292,12 @@ with tab5:
         col1, col2 = st.columns(2)
         with col1:
             fmt = st.selectbox("Select Export Format", ["docx", "pdf"], label_visibility="collapsed")
+            illustrated = st.checkbox("Include cover and chapter illustrations", value=False, key="illustrated_export")
         with col2:
             if st.button("Export Book", use_container_width=True, key="export_book_btn"):
                 with st.spinner(f"Exporting as {fmt.upper()}..."):
                     try:
-                        resp = requests.post(f"{BACKEND_URL}/export_book", json={"book": st.session_state.book_data, "format": fmt}, timeout=60)
+                        resp = post_json("/export_book", {"book": st.session_state.book_data, "format": fmt, "illustrated": illustrated}, timeout=60)
                         if resp.status_code == 200:
                             filename = f"bookforge_{st.session_state.book_data.get('title', 'book').replace(' ', '_')}.{fmt}"
                             mime_type = "application/pdf" if fmt == "pdf" else "application/vnd.openxmlformats-officedocument.wordprocessingml.document"